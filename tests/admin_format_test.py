@@ -0,0 +1,98 @@
+import random
+import string
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import pytest
+import pytest_mock
+
+from update_alternatives import AlternativeUpdater
+
+Query = AlternativeUpdater.Query
+
+# every way of parsing an admin file, all of them must agree with 'reference'
+PARSER_BACKENDS: Dict[str, Callable[[Path], Query]] = {
+    'reference': lambda path: Query.parse(path),
+    # what install does with the text it already read
+    'text': lambda path: Query.parse(path, path.read_text('utf-8')),
+}
+
+PATH_CHARACTERS = string.ascii_letters + string.digits + '._-+'
+
+
+def random_path(rng: random.Random) -> str:
+    parts = [''.join(rng.choices(PATH_CHARACTERS, k=rng.randint(1, 40)))
+             for _ in range(rng.randint(1, 6))]
+    return '/' + '/'.join(parts)
+
+
+def random_query(rng: random.Random, name: str) -> Query:
+    """a valid admin file, as parse would return it"""
+    secondaries = [Query.Secondary(name=f'{name}-{i}.{rng.randint(0, 9)}', link=random_path(rng))
+                   for i in range(rng.choice([0, 0, 1, 2, 8]))]
+    alternatives = []
+    for location in dict.fromkeys(random_path(rng) for _ in range(rng.randint(1, 40))):
+        alt_secondaries = []
+        for _ in secondaries:
+            # a choice does not have to provide every secondary
+            link = random_path(rng) if rng.random() < 0.9 else ''
+            alt_secondaries.append(Query.Secondary(name=link.rpartition('/')[2], link=link))
+        alternatives.append(Query.Alternative(
+            location=location,
+            priority=rng.randint(-100, 100000),
+            secondaries=alt_secondaries,
+        ))
+
+    link = random_path(rng)
+    return Query(
+        name=name,
+        link=link,
+        status=rng.choice(['auto', 'manual']),
+        best=Query.Alternative.best(*alternatives).location,
+        value=f'/etc/alternatives/{link.rpartition("/")[2]}',
+        secondaries=secondaries,
+        alternatives=alternatives,
+    )
+
+
+def corpus(tmp_path: Path, seed: int, size: int) -> List[Query]:
+    rng = random.Random(seed)
+    queries = [random_query(rng, f'alternative-{seed}-{i}') for i in range(size)]
+    for query in queries:
+        tmp_path.joinpath(query.name).write_text(query.stringify())
+    return queries
+
+
+@pytest.fixture(autouse=True)
+def fixed_value(mocker: pytest_mock.MockerFixture):
+    mocker.patch('update_alternatives._readlink_f',
+                 side_effect=lambda p, instdir='': f'/etc/alternatives/{p.name}')
+
+
+@pytest.mark.parametrize('backend', PARSER_BACKENDS)
+@pytest.mark.parametrize('seed', range(20))
+def test_round_trip(tmp_path: Path, seed: int, backend: str):
+    parse = PARSER_BACKENDS[backend]
+    for expected in corpus(tmp_path, seed, 5):
+        path = tmp_path.joinpath(expected.name)
+
+        query = parse(path)
+        assert query == expected, f'seed {seed}: {path.name}'
+        assert query.stringify() == path.read_text(), f'seed {seed}: {path.name}'
+
+
+def test_backend_timing(tmp_path: Path):
+    """times every backend on one corpus; run with -s to see the numbers"""
+    queries = corpus(tmp_path, 0, 200)
+    paths = [tmp_path.joinpath(q.name) for q in queries]
+
+    results = {}
+    for backend, parse in PARSER_BACKENDS.items():
+        start = time.perf_counter()
+        results[backend] = [parse(p) for p in paths]
+        elapsed = time.perf_counter() - start
+        print(f'{backend}: {elapsed * 1000:.1f}ms for {len(paths)} files')
+
+    for backend, parsed in results.items():
+        assert parsed == results['reference'], backend
@@ -1,10 +1,17 @@
+import os
 import textwrap
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Iterator
 
 import pytest
 import pytest_mock
 
-from update_alternatives import AlternativeUpdater
+import update_alternatives
+from update_alternatives import AlternativeUpdater, Options, Removal, Name, \
+    Configuration, Archive, Installation, Watch
 
 
 @pytest.fixture
@@ -193,3 +200,441 @@ def test_to_query(sample: str,
     query = alternative_updater.Query.parse(sample_path)
     actual = query.to_query().strip()
     assert expected == actual
+
+
+@pytest.fixture
+def tree(tmp_path: Path) -> Path:
+    """a root with a 'java' alternative, two choices and one secondary"""
+    for d in ['admin', 'alt', 'bin', 'man', 'opt/jdk-11', 'opt/jdk-17']:
+        tmp_path.joinpath(d).mkdir(parents=True)
+    for jdk in ['jdk-11', 'jdk-17']:
+        tmp_path.joinpath('opt', jdk, 'java').touch()
+        tmp_path.joinpath('opt', jdk, 'java.1').touch()
+
+    opt = tmp_path.joinpath('opt')
+    tmp_path.joinpath('admin', 'java').write_text(AlternativeUpdater.Query(
+        name='java',
+        link=str(tmp_path.joinpath('bin', 'java')),
+        status='auto',
+        best=f'{opt}/jdk-17/java',
+        value=f'{opt}/jdk-17/java',
+        secondaries=[AlternativeUpdater.Query.Secondary(
+            name='java.1', link=str(tmp_path.joinpath('man', 'java.1')))],
+        alternatives=[
+            AlternativeUpdater.Query.Alternative(
+                location=f'{opt}/{jdk}/java', priority=priority,
+                secondaries=[AlternativeUpdater.Query.Secondary(
+                    name='java.1', link=f'{opt}/{jdk}/java.1')])
+            for jdk, priority in [('jdk-11', 11), ('jdk-17', 17)]
+        ]
+    ).stringify())
+
+    tmp_path.joinpath('alt', 'java').symlink_to(opt.joinpath('jdk-17', 'java'))
+    tmp_path.joinpath('alt', 'java.1').symlink_to(opt.joinpath('jdk-17', 'java.1'))
+    tmp_path.joinpath('bin', 'java').symlink_to(tmp_path.joinpath('alt', 'java'))
+    tmp_path.joinpath('man', 'java.1').symlink_to(tmp_path.joinpath('alt', 'java.1'))
+    return tmp_path
+
+
+def tree_updater(tree: Path) -> AlternativeUpdater:
+    return AlternativeUpdater(Options(
+        admindir=str(tree.joinpath('admin')),
+        altdir=str(tree.joinpath('alt')),
+    ))
+
+
+def test_remove_falls_back_to_best(tree: Path):
+    updater = tree_updater(tree)
+    updater.remove(Removal(name='java', path=str(tree.joinpath('opt', 'jdk-17', 'java'))))
+
+    query = AlternativeUpdater.Query.parse(tree.joinpath('admin', 'java'))
+    assert [a.location for a in query.alternatives] == [str(tree.joinpath('opt', 'jdk-11', 'java'))]
+    assert os.readlink(tree.joinpath('alt', 'java')) == str(tree.joinpath('opt', 'jdk-11', 'java'))
+    assert os.readlink(tree.joinpath('alt', 'java.1')) == str(tree.joinpath('opt', 'jdk-11', 'java.1'))
+
+
+def test_remove_unregistered(tree: Path):
+    with pytest.raises(Exception, match='not a registered alternative'):
+        tree_updater(tree).remove(Removal(name='java', path='/nope'))
+
+
+def test_remove_all(tree: Path):
+    tree_updater(tree).remove_all(Name(name='java'))
+
+    assert not tree.joinpath('admin', 'java').exists()
+    for link in [('alt', 'java'), ('alt', 'java.1'), ('bin', 'java'), ('man', 'java.1')]:
+        assert not os.path.lexists(tree.joinpath(*link))
+
+
+def test_remove_all_keeps_files(tree: Path):
+    # a real file took the place of the master link, another link the secondary's
+    tree.joinpath('bin', 'java').unlink()
+    tree.joinpath('bin', 'java').write_text('not ours')
+    tree.joinpath('man', 'java.1').unlink()
+    tree.joinpath('man', 'java.1').symlink_to('/elsewhere')
+
+    tree_updater(tree).remove_all(Name(name='java'))
+
+    assert tree.joinpath('bin', 'java').read_text() == 'not ours'
+    assert os.readlink(tree.joinpath('man', 'java.1')) == '/elsewhere'
+    assert not os.path.lexists(tree.joinpath('alt', 'java'))
+
+
+def test_remove_prefix(tree: Path, capsys: pytest.CaptureFixture):
+    updater = tree_updater(tree)
+    # unreadable admin files are reported and left alone
+    tree.joinpath('admin', 'partial').write_text('auto\n')
+    updater.remove(Removal(prefix=str(tree.joinpath('opt', 'jdk-17'))))
+    query = AlternativeUpdater.Query.parse(tree.joinpath('admin', 'java'))
+    assert query.best == str(tree.joinpath('opt', 'jdk-11', 'java'))
+
+    updater.remove(Removal(prefix=str(tree.joinpath('opt'))))
+    assert not tree.joinpath('admin', 'java').exists()
+    assert tree.joinpath('admin', 'partial').read_text() == 'auto\n'
+    assert 'could not read' in capsys.readouterr().err
+
+
+def test_reconcile_repairs_links(tree: Path):
+    updater = tree_updater(tree)
+    jdk_17 = tree.joinpath('opt', 'jdk-17')
+
+    # someone replaced the alternative link and deleted the master link
+    tree.joinpath('alt', 'java').unlink()
+    tree.joinpath('alt', 'java').symlink_to('/somewhere/else')
+    tree.joinpath('bin', 'java').unlink()
+    updater._reconcile('java')
+    assert os.readlink(tree.joinpath('alt', 'java')) == str(jdk_17.joinpath('java'))
+    assert os.readlink(tree.joinpath('bin', 'java')) == str(tree.joinpath('alt', 'java'))
+
+    # the best alternative was deleted from underneath us
+    jdk_17.joinpath('java').unlink()
+    updater._reconcile('java')
+    assert os.readlink(tree.joinpath('alt', 'java')) == str(tree.joinpath('opt', 'jdk-11', 'java'))
+    assert os.readlink(tree.joinpath('alt', 'java.1')) == str(tree.joinpath('opt', 'jdk-11', 'java.1'))
+    query = AlternativeUpdater.Query.parse(tree.joinpath('admin', 'java'))
+    assert len(query.alternatives) == 1
+
+
+@pytest.mark.parametrize('watcher_type', ['inotify', 'poll'])
+def test_watcher_reports_changes(tree: Path, watcher_type: str):
+    if watcher_type == 'inotify':
+        try:
+            watcher = update_alternatives._InotifyWatcher()
+        except (OSError, AttributeError, TypeError):
+            pytest.skip('inotify is not available')
+    else:
+        watcher = update_alternatives._PollWatcher(0.01)
+
+    index = tree_updater(tree)._watch_index()
+    assert index[str(tree.joinpath('alt', 'java.1'))] == {'java'}
+    try:
+        watcher.watch(list(index))
+        assert watcher.read(0.05) == []
+        tree.joinpath('opt', 'jdk-11', 'java').unlink()
+        assert str(tree.joinpath('opt', 'jdk-11', 'java')) in watcher.read(1)
+    finally:
+        watcher.close()
+
+
+def test_config_choose(tree: Path):
+    updater = tree_updater(tree)
+    jdk_11 = str(tree.joinpath('opt', 'jdk-11', 'java'))
+
+    updater.config(Configuration(name='java', choose=jdk_11))
+    assert os.readlink(tree.joinpath('alt', 'java')) == jdk_11
+    assert AlternativeUpdater.Query.parse(tree.joinpath('admin', 'java')).status == 'manual'
+
+    updater.config(Configuration(name='java', choose='0'))
+    assert os.readlink(tree.joinpath('alt', 'java')) == str(tree.joinpath('opt', 'jdk-17', 'java'))
+    assert AlternativeUpdater.Query.parse(tree.joinpath('admin', 'java')).status == 'auto'
+
+    with pytest.raises(Exception, match='valid choices are between 0 and 2'):
+        updater.config(Configuration(name='java', choose='3'))
+
+
+def test_config_filter_and_pages(tree: Path,
+                                 mocker: pytest_mock.MockerFixture,
+                                 capsys: pytest.CaptureFixture):
+    prompt = mocker.patch('builtins.input', side_effect=['n', '1'])
+    tree_updater(tree).config(Configuration(name='java', filter='jdk-1', page=2))
+
+    out = capsys.readouterr().out
+    assert [line.split()[-5] for line in out.splitlines() if 'mode' in line] \
+           == ['0', '1', '2']
+    assert prompt.call_count == 2
+    assert os.readlink(tree.joinpath('alt', 'java')) == str(tree.joinpath('opt', 'jdk-11', 'java'))
+
+    capsys.readouterr()
+    mocker.patch('builtins.input', return_value='')
+    tree_updater(tree).config(Configuration(name='java', filter='*/jdk-11/*'))
+    manual = [line for line in capsys.readouterr().out.splitlines() if 'manual mode' in line]
+    assert len(manual) == 1 and manual[0].startswith('* 1') and 'jdk-11' in manual[0]
+
+
+def test_snapshot_restore(tree: Path, capsys: pytest.CaptureFixture):
+    updater = tree_updater(tree)
+    archive = Archive(path=str(tree.joinpath('alternatives.snapshot')))
+    updater.snapshot(archive)
+    golden = updater._state()
+
+    # drift: a manual selection, a broken link and an unknown alternative
+    updater.config(Configuration(name='java', choose='1'))
+    tree.joinpath('alt', 'java.1').unlink()
+    tree.joinpath('admin', 'vim').write_text(
+        Path(__file__).parent.joinpath('sample-alternatives-files', 'vim').read_text())
+    assert updater._state() != golden
+
+    updater.restore(archive)
+    assert updater._state() == golden
+    assert not tree.joinpath('admin', 'vim').exists()
+
+    capsys.readouterr()
+    updater.restore(archive)
+    assert 'already matches' in capsys.readouterr().out
+
+    # a fresh root gets the same admin files and altdir links
+    fresh = tree_updater(tree.joinpath('fresh'))
+    fresh.restore(archive)
+    assert fresh._state() == golden
+
+
+def test_restore_keeps_files(tree: Path):
+    updater = tree_updater(tree)
+    archive = Archive(path=str(tree.joinpath('alternatives.snapshot')))
+    updater.snapshot(archive)
+
+    # two groups which are not in the snapshot: one all ours, one
+    # whose links were replaced by something else
+    for name in ['ours', 'theirs']:
+        tree.joinpath('admin', name).write_text(AlternativeUpdater.Query(
+            name=name, link=str(tree.joinpath('bin', name)), status='auto',
+            best='', value='',
+            alternatives=[AlternativeUpdater.Query.Alternative(
+                location=str(tree.joinpath('opt', 'jdk-11', 'java')), priority=1)]
+        ).stringify())
+    tree.joinpath('alt', 'ours').symlink_to(tree.joinpath('opt', 'jdk-11', 'java'))
+    tree.joinpath('bin', 'ours').symlink_to(tree.joinpath('alt', 'ours'))
+    tree.joinpath('alt', 'theirs').write_text('not ours')
+    tree.joinpath('bin', 'theirs').symlink_to('/elsewhere')
+
+    updater.restore(archive)
+
+    assert sorted(os.listdir(tree.joinpath('admin'))) == ['java']
+    assert not os.path.lexists(tree.joinpath('alt', 'ours'))
+    assert not os.path.lexists(tree.joinpath('bin', 'ours'))
+    assert tree.joinpath('alt', 'theirs').read_text() == 'not ours'
+    assert os.readlink(tree.joinpath('bin', 'theirs')) == '/elsewhere'
+
+
+def test_install_appends_or_replaces(tree: Path):
+    updater = tree_updater(tree)
+    admin = tree.joinpath('admin', 'java')
+    jdk_21 = tree.joinpath('opt', 'jdk-21', 'java')
+    jdk_21.parent.mkdir()
+    jdk_21.touch()
+    inode = os.stat(admin).st_ino
+
+    # a new alternative is appended to the existing file
+    updater.install(Installation(link=str(tree.joinpath('bin', 'java')), name='java',
+                                 path=str(jdk_21), priority=21))
+    assert os.stat(admin).st_ino == inode
+    query = AlternativeUpdater.Query.parse(admin)
+    assert [a.priority for a in query.alternatives] == [11, 17, 21]
+    assert query.stringify() == admin.read_text()
+    assert os.readlink(tree.joinpath('alt', 'java')) == str(jdk_21)
+    assert not os.path.lexists(tree.joinpath('alt', 'java.1'))
+
+    # anything else replaces it
+    updater.install(Installation(link=str(tree.joinpath('bin', 'java')), name='java',
+                                 path=str(tree.joinpath('opt', 'jdk-11', 'java')), priority=30))
+    assert os.stat(admin).st_ino != inode
+    query = AlternativeUpdater.Query.parse(admin)
+    assert [a.priority for a in query.alternatives] == [30, 17, 21]
+    assert os.readlink(tree.joinpath('alt', 'java.1')) == str(tree.joinpath('opt', 'jdk-11', 'java.1'))
+
+
+def test_write_admin_replace(tmp_path: Path, mocker: pytest_mock.MockerFixture):
+    admin = tmp_path.joinpath('x')
+    admin.write_text('auto\n/bin/x\n\n/a\n1\n\n')
+    admin.chmod(0o600)
+
+    # short writes are continued, and the mode survives the rename
+    write = os.write
+    mocker.patch('os.write', side_effect=lambda fd, data: write(fd, bytes(data[:3])))
+    update_alternatives._write_admin(str(admin), None, 'manual\n/bin/x\n\n/a\n2\n\n')
+    assert admin.read_text() == 'manual\n/bin/x\n\n/a\n2\n\n'
+    assert admin.stat().st_mode & 0o777 == 0o600
+
+    # a failed write leaves the file alone, and no temporary file behind
+    mocker.patch('os.write', side_effect=OSError(28, 'No space left on device'))
+    with pytest.raises(OSError):
+        update_alternatives._write_admin(str(admin), None, 'auto\n/bin/x\n\n/a\n3\n\n')
+    assert admin.read_text() == 'manual\n/bin/x\n\n/a\n2\n\n'
+    assert os.listdir(tmp_path) == ['x']
+
+
+def test_write_admin_concurrent_change(tmp_path: Path):
+    admin = tmp_path.joinpath('x')
+    stale = 'auto\n/bin/x\n\n/a\n1\n\n'
+    admin.write_text('auto\n/bin/x\n\n/b\n2\n\n')
+
+    # neither an append nor a replacement built from stale content happens
+    for new in [stale[:-1] + '/c\n3\n\n', 'auto\n/bin/x\n\n/a\n5\n\n']:
+        with pytest.raises(Exception, match='changed while it was being updated'):
+            update_alternatives._write_admin(str(admin), stale, new)
+        assert admin.read_text() == 'auto\n/bin/x\n\n/b\n2\n\n'
+
+
+def test_install_new(tree: Path):
+    tree_updater(tree).install(Installation(
+        link=str(tree.joinpath('bin', 'javac')), name='javac',
+        path=str(tree.joinpath('opt', 'jdk-17', 'java')), priority=17))
+    assert tree.joinpath('admin', 'javac').read_text() == textwrap.dedent(f"""\
+        auto
+        {tree.joinpath('bin', 'javac')}
+
+        {tree.joinpath('opt', 'jdk-17', 'java')}
+        17
+
+        """)
+    assert os.readlink(tree.joinpath('bin', 'javac')) == str(tree.joinpath('alt', 'javac'))
+
+
+def test_root(tmp_path: Path):
+    for d in ['admin', 'alt', 'bin', 'opt/jdk']:
+        tmp_path.joinpath(d).mkdir(parents=True)
+    tmp_path.joinpath('opt', 'jdk', 'java').touch()
+    updater = AlternativeUpdater(Options(root=str(tmp_path), admindir='/admin', altdir='/alt'))
+
+    updater.install(Installation(link='/bin/java', name='java', path='/opt/jdk/java', priority=1))
+    assert os.readlink(tmp_path.joinpath('bin', 'java')) == '/alt/java'
+    assert os.readlink(tmp_path.joinpath('alt', 'java')) == '/opt/jdk/java'
+    assert updater._query('java').link == '/bin/java'
+
+    updater.remove_all(Name(name='java'))
+    assert os.listdir(tmp_path.joinpath('admin')) == []
+    assert not os.path.lexists(tmp_path.joinpath('bin', 'java'))
+
+
+def test_root_query_display(tmp_path: Path, capsys: pytest.CaptureFixture):
+    for d in ['admin', 'alt', 'bin', 'opt/jdk']:
+        tmp_path.joinpath(d).mkdir(parents=True)
+    tmp_path.joinpath('opt', 'jdk', 'java').touch()
+    updater = AlternativeUpdater(Options(root=str(tmp_path), admindir='/admin', altdir='/alt'))
+    updater.install(Installation(link='/bin/java', name='java', path='/opt/jdk/java', priority=1))
+    assert updater._query('java').value == '/opt/jdk/java'
+
+    capsys.readouterr()
+    updater.query(Name(name='java'))
+    assert 'Value: /opt/jdk/java' in capsys.readouterr().out.splitlines()
+
+    updater.display(Name(name='java'))
+    assert '  link currently points to /opt/jdk/java' in capsys.readouterr().out.splitlines()
+
+
+def test_inotify_directory_recreated(tree: Path):
+    try:
+        watcher = update_alternatives._InotifyWatcher()
+    except (OSError, AttributeError, TypeError):
+        pytest.skip('inotify is not available')
+
+    jdk = tree.joinpath('opt', 'jdk-11')
+    try:
+        watcher.watch([str(jdk.joinpath('java'))])
+        for f in jdk.iterdir():
+            f.unlink()
+        jdk.rmdir()
+        assert update_alternatives._RESCAN in watcher.read(1)
+
+        jdk.mkdir()
+        watcher.watch([str(jdk.joinpath('java'))])
+        jdk.joinpath('java').touch()
+        assert str(jdk.joinpath('java')) in watcher.read(1)
+    finally:
+        watcher.close()
+
+
+class StopWatching(Exception):
+    pass
+
+
+class StoppablePollWatcher(update_alternatives._PollWatcher):
+    stop = False
+
+    def read(self, timeout):
+        if self.stop:
+            raise StopWatching()
+        return super().read(timeout)
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+@contextmanager
+def watching(tree: Path, mocker: pytest_mock.MockerFixture) -> Iterator[threading.Thread]:
+    """runs watch on tree, with a poll watcher, for the duration"""
+    watcher = StoppablePollWatcher(0.01)
+    mocker.patch('update_alternatives._watcher', return_value=watcher)
+
+    def watch():
+        try:
+            tree_updater(tree).watch(Watch(debounce=0.02))
+        except StopWatching:
+            pass
+
+    thread = threading.Thread(target=watch, daemon=True)
+    thread.start()
+    try:
+        yield thread
+    finally:
+        watcher.stop = True
+        thread.join(5)
+
+
+def test_watch_survives_failures(tree: Path, mocker: pytest_mock.MockerFixture):
+    # relinking this one fails, as its master link's directory is missing
+    tree.joinpath('admin', 'orphan').write_text(AlternativeUpdater.Query(
+        name='orphan', link=str(tree.joinpath('gone', 'orphan')), status='auto',
+        best='', value='',
+        alternatives=[AlternativeUpdater.Query.Alternative(
+            location=str(tree.joinpath('opt', 'jdk-11', 'java')), priority=1)]
+    ).stringify())
+
+    with watching(tree, mocker) as thread:
+        wait_for(lambda: os.path.lexists(tree.joinpath('alt', 'orphan')))
+
+        # a half written admin file, then the best choice disappears
+        tree.joinpath('admin', 'partial').write_text('auto\n')
+        time.sleep(0.1)
+        tree.joinpath('opt', 'jdk-17', 'java').unlink()
+        # the link is briefly missing while it is being replaced
+        wait_for(lambda: update_alternatives._readlink(tree.joinpath('alt', 'java'))
+                 == str(tree.joinpath('opt', 'jdk-11', 'java')))
+        assert thread.is_alive()
+
+
+def test_watch_recreates_master_link(tree: Path, mocker: pytest_mock.MockerFixture):
+    with watching(tree, mocker):
+        time.sleep(0.1)
+        tree.joinpath('bin', 'java').unlink()
+        wait_for(lambda: update_alternatives._readlink(tree.joinpath('bin', 'java'))
+                 == str(tree.joinpath('alt', 'java')))
+
+
+def test_reconcile_idle_after_install(tree: Path, mocker: pytest_mock.MockerFixture):
+    updater = tree_updater(tree)
+    jdk_21 = tree.joinpath('opt', 'jdk-21', 'java')
+    jdk_21.parent.mkdir()
+    jdk_21.touch()
+    # the new choice provides no java.1 secondary
+    updater.install(Installation(link=str(tree.joinpath('bin', 'java')), name='java',
+                                 path=str(jdk_21), priority=21))
+
+    link = mocker.spy(updater, 'link_alternative')
+    for _ in range(3):
+        updater._reconcile('java')
+    assert link.call_count == 0
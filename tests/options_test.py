@@ -3,7 +3,8 @@ from pathlib import Path
 
 import pytest
 
-from update_alternatives import Options, read_options, OPTIONS_LOCATIONS
+from update_alternatives import Options, read_options, OPTIONS_LOCATIONS, ResolvedOptions, \
+    _read_option_files
 
 SAMPLES = Path(__file__).parent.joinpath('sample-run-command-files')
 
@@ -55,3 +56,39 @@ def test_multiple_locations(tmp_path: Path):
     OPTIONS_LOCATIONS.append(tmp_path.joinpath('partial2.toml'))
     OPTIONS_LOCATIONS.append(tmp_path.joinpath('partial.toml'))
     assert Options(admindir='admin-dir', log='log2') == read_options()
+
+
+def test_read_options_cached(tmp_path: Path):
+    location = tmp_path.joinpath('partial.toml')
+    shutil.copy(src=SAMPLES.joinpath('partial.toml'), dst=location)
+    assert Options(admindir='admin-dir') == read_options([location])
+    hits = _read_option_files.cache_info().hits
+    assert Options(admindir='admin-dir') == read_options([location])
+    assert _read_option_files.cache_info().hits == hits + 1
+
+    # changing the file is noticed
+    shutil.copy(src=SAMPLES.joinpath('partial2.toml'), dst=location)
+    assert Options(admindir='admin2-dir', log='log2') == read_options([location])
+
+
+@pytest.mark.parametrize('options,admindir,altdir,link', [
+    [Options(admindir='/admin/', altdir='/alt'), '/admin', '/alt', '/bin/x'],
+    [Options(admindir='/admin', altdir='/alt', root='/r'), '/r/admin', '/r/alt', '/r/bin/x'],
+    [Options(admindir='/admin', altdir='/alt', root='/r', instdir='/i'), '/r/admin', '/i/alt', '/i/bin/x'],
+    [Options(admindir='/admin', altdir='/alt', instdir='/i/'), '/admin', '/i/alt', '/i/bin/x'],
+])
+def test_resolved_options(options, admindir, altdir, link):
+    resolved = ResolvedOptions.of(options)
+    assert resolved.admin('x') == f'{admindir}/x'
+    assert resolved.alt('x') == f'{altdir}/x'
+    assert resolved.target_alt('x') == '/alt/x'
+    assert resolved.inst('/bin/x') == link
+
+
+@pytest.mark.parametrize('options,missing', [
+    [Options(altdir='/alt'), 'admindir'],
+    [Options(admindir='/admin', root='/r'), 'altdir'],
+])
+def test_resolved_options_required(options, missing):
+    with pytest.raises(Exception, match=f'{missing} is not set'):
+        ResolvedOptions.of(options)
@@ -1,9 +1,23 @@
+import gzip
+import hashlib
+import json
 import os
+import select
+import shutil
+import stat
+import struct
+import sys
+import time
 from argparse import ArgumentParser
-from dataclasses import dataclass, fields, field, asdict
+from collections import defaultdict
+from dataclasses import dataclass, fields, field, replace, MISSING
 from enum import Enum
+from functools import lru_cache
+from fnmatch import fnmatchcase
+from itertools import islice, chain
 from pathlib import Path
-from typing import TypeVar, Type, Optional, Dict, Any, List, Union
+from typing import TypeVar, Type, Optional, Dict, Any, List, Union, \
+    Iterable, Iterator, Callable, Set, Tuple, get_args
 
 try:
     import tomllib
@@ -54,6 +68,12 @@ class Command(Enum):
     list = 'list'
     # --config name
     config = 'config'
+    # watch admindir and altdir, repairing alternatives as they break
+    watch = 'watch'
+    # snapshot file (write the state of all alternatives to a file)
+    snapshot = 'snapshot'
+    # restore file (make all alternatives match a snapshot)
+    restore = 'restore'
 
 
 @dataclass
@@ -76,15 +96,48 @@ class NameAndPath:
     path: str
 
 
+@dataclass
+class Removal:
+    # positional, but may be omitted when --prefix is given
+    name: Optional[str] = field(default=None, metadata={'positional': True})
+    path: Optional[str] = field(default=None, metadata={'positional': True})
+    # purge every alternative located under this directory
+    prefix: Optional[str] = None
+
+
 @dataclass
 class Name:
     name: str
 
 
+@dataclass
+class Configuration:
+    name: str
+    # only list choices containing this text (or matching it as a glob)
+    filter: Optional[str] = None
+    # selection number or path, instead of prompting
+    choose: Optional[str] = None
+    # choices per page, defaults to the terminal height
+    page: Optional[int] = None
+
+
+@dataclass
+class Archive:
+    path: str
+
+
+@dataclass
+class Watch:
+    # seconds to wait for a burst of events to settle
+    debounce: Optional[float] = None
+    # poll every this many seconds instead of using inotify
+    poll: Optional[float] = None
+
+
 COMMANDS_TYPES: Dict[Command, Optional[Type[Any]]] = {
     Command.install: Installation,
     Command.set: NameAndPath,
-    Command.remove: NameAndPath,
+    Command.remove: Removal,
     Command.remove_all: Name,
     Command.all: None,
     Command.auto: Name,
@@ -93,7 +146,10 @@ COMMANDS_TYPES: Dict[Command, Optional[Type[Any]]] = {
     Command.set_selections: None,
     Command.query: Name,
     Command.list: Name,
-    Command.config: Name,
+    Command.config: Configuration,
+    Command.watch: Watch,
+    Command.snapshot: Archive,
+    Command.restore: Archive,
 }
 
 
@@ -117,11 +173,11 @@ class Options:
 
     def combine_with(self, argument: 'Options') -> 'Options':
         """self is lower priority than argument"""
-        me = {k: v for (k, v) in asdict(self).items() if v is not None}
-        you = {k: v for (k, v) in asdict(argument).items() if v is not None}
-        me.update(you)
-        return Options(**me)
+        you = {n: getattr(argument, n) for n in _OPTION_NAMES}
+        return replace(self, **{k: v for (k, v) in you.items() if v is not None})
+
 
+_OPTION_NAMES = [f.name for f in fields(Options)]
 
 # in order of lowest to highest priority
 OPTIONS_LOCATIONS = [
@@ -132,33 +188,402 @@ OPTIONS_LOCATIONS = [
 
 def read_options(locations: Optional[List[Union[str, Path]]] = None,
                  final_options: Optional[Options] = None):
-    o = Options()
     locations = locations or OPTIONS_LOCATIONS
-    for location in locations:
-        if location.exists() and location.is_file():
-            o = o.combine_with(Options.from_toml(location.read_text('utf-8')))
+    # the files are only read again once one of them changes
+    o = _read_option_files(tuple(_stamp(location) for location in locations))
     if final_options:
-        o = o.combine_with(final_options)
+        return o.combine_with(final_options)
+    return replace(o)
+
+
+def _stamp(location: Union[str, Path]) -> Tuple[str, Optional[Tuple[int, int]]]:
+    try:
+        st = os.stat(location)
+    except OSError:
+        return str(location), None
+    if not stat.S_ISREG(st.st_mode):
+        return str(location), None
+    return str(location), (st.st_mtime_ns, st.st_size)
+
+
+@lru_cache(maxsize=16)
+def _read_option_files(stamps: Tuple[Tuple[str, Optional[Tuple[int, int]]], ...]) -> Options:
+    o = Options()
+    for location, st in stamps:
+        if st is not None:
+            o = o.combine_with(Options.from_toml(Path(location).read_text('utf-8')))
     return o
 
 
-def _readlink_f(path: Path) -> Path:
-    while path.is_symlink():
-        path = path.readlink()
+def _prefixed(prefix: str, path: str) -> str:
+    if not prefix:
+        return os.path.normpath(path)
+    return os.path.normpath(prefix + '/' + path.lstrip('/'))
+
+
+@dataclass(frozen=True)
+class ResolvedOptions:
+    """
+    Options with root and instdir applied to the directories, so that paths
+    are built by concatenation instead of through Path on every use
+    """
+    options: Options
+    # where admin files are, under root
+    admindir: str
+    # where altdir links are, under instdir
+    altdir: str
+    # altdir as seen from inside the root, which is what links point to
+    target_altdir: str
+    # prefix of link paths and alternatives (empty for none)
+    instdir: str
+
+    @staticmethod
+    def of(options: Options) -> 'ResolvedOptions':
+        for name in ['admindir', 'altdir']:
+            if getattr(options, name) is None:
+                raise Exception(f'{name} is not set, pass --{name} or set it in an rc file')
+        root = options.root or ''
+        instdir = root if options.instdir is None else options.instdir
+        return ResolvedOptions(
+            options=options,
+            admindir=_prefixed(root, options.admindir),
+            altdir=_prefixed(instdir, options.altdir),
+            target_altdir=_prefixed('', options.altdir),
+            instdir=instdir.rstrip('/'),
+        )
+
+    def admin(self, name: str) -> str:
+        return f'{self.admindir}/{name}'
+
+    def alt(self, name: str) -> str:
+        return f'{self.altdir}/{name}'
+
+    def target_alt(self, name: str) -> str:
+        return f'{self.target_altdir}/{name}'
+
+    def inst(self, path: str) -> str:
+        """a link or alternative path as seen from outside the root"""
+        return self.instdir + path if self.instdir else path
+
+
+def _readlink_f(path: Path, instdir: str = '') -> Path:
+    """
+    follows symlinks to the end, path and the result being as seen from
+    inside instdir: every hop is looked up with the instdir prefix
+    """
+    while os.path.islink(f'{instdir}{path}'):
+        target = os.readlink(f'{instdir}{path}')
+        path = Path(os.path.join(os.path.dirname(path), target))
     return path
 
 
+def _read_text(path: Union[str, Path]) -> str:
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def _readlink(path: Union[str, Path]) -> Optional[str]:
+    """one level of symlink resolution, None if not a symlink"""
+    try:
+        return os.readlink(path)
+    except OSError:
+        return None
+
+
+def _unlink_all(paths: Iterable[Union[str, Path]]):
+    """removes every path, ignoring the ones which are already gone"""
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _is_under(location: str, prefix: str) -> bool:
+    prefix = prefix.rstrip('/')
+    return location == prefix or location.startswith(prefix + '/')
+
+
+def _matcher(pattern: Optional[str]) -> Callable[[str], bool]:
+    """substring match, or glob match when pattern has glob characters"""
+    if pattern is None:
+        return lambda _: True
+    if any(c in pattern for c in '*?['):
+        return lambda location: fnmatchcase(location, pattern)
+    return lambda location: pattern in location
+
+
+def _checksum(state: Dict[str, Any]) -> str:
+    canonical = json.dumps(state, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _write_all(fd: int, data: bytes, offset: Optional[int] = None):
+    """writes every byte, as os.write/os.pwrite may write only some"""
+    view = memoryview(data)
+    while view:
+        if offset is None:
+            written = os.write(fd, view)
+        else:
+            written = os.pwrite(fd, view, offset)
+            offset += written
+        view = view[written:]
+
+
+def _replace_file(dir_fd: int, name: str, text: Optional[str]):
+    """atomically writes name in dir_fd, keeping its mode"""
+    try:
+        mode = stat.S_IMODE(os.stat(name, dir_fd=dir_fd).st_mode)
+    except FileNotFoundError:
+        mode = 0o644
+    tmp = f'.{name}.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode, dir_fd=dir_fd)
+    try:
+        try:
+            # not subject to the umask, unlike the mode given to open
+            os.fchmod(fd, mode)
+            _write_all(fd, text.encode('utf-8'))
+            # the rename must not be able to expose a partly written file
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except BaseException:
+        _unlink_at(dir_fd, tmp)
+        raise
+    os.replace(tmp, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+
+
+def _replace_symlink(dir_fd: int, name: str, target: Optional[str]):
+    """atomically points name in dir_fd at target, None removes it"""
+    if target is None:
+        # never remove anything that is not a symlink
+        try:
+            os.readlink(name, dir_fd=dir_fd)
+        except OSError:
+            return
+        _unlink_at(dir_fd, name)
+        return
+    tmp = f'.{name}.tmp'
+    _unlink_at(dir_fd, tmp)
+    os.symlink(target, tmp, dir_fd=dir_fd)
+    os.replace(tmp, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+
+
+def _unlink_at(dir_fd: int, name: str):
+    try:
+        os.unlink(name, dir_fd=dir_fd)
+    except FileNotFoundError:
+        pass
+
+
+def _apply_dir(directory: str,
+               entries: Dict[str, Optional[str]],
+               extra: Iterable[str],
+               apply: Callable[[int, str, Optional[str]], None]):
+    """applies entries and removes extra names with one open directory"""
+    if not entries and not extra:
+        return
+    os.makedirs(directory, exist_ok=True)
+    dir_fd = os.open(directory, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    try:
+        for name, value in entries.items():
+            apply(dir_fd, name, value)
+        for name in extra:
+            _unlink_at(dir_fd, name)
+    finally:
+        os.close(dir_fd)
+
+
+def _write_admin(path: str, old: Optional[str], new: str):
+    """
+    writes an admin file given its previous content (None if unknown):
+    nothing when unchanged, appends in place when alternatives were only
+    added at the end, and otherwise replaces the file atomically
+    """
+    if old == new:
+        return
+    if old is None:
+        directory, name = os.path.split(path)
+        _apply_dir(directory, {name: new}, (), _replace_file)
+        return
+
+    old_b, new_b = old.encode('utf-8'), new.encode('utf-8')
+    fd = os.open(path, os.O_RDWR)
+    try:
+        # new was made from old, writing it would lose a change made since
+        with os.fdopen(os.dup(fd), 'rb') as f:
+            if f.read() != old_b:
+                raise Exception(f'{path} changed while it was being updated')
+
+        # both end with the empty line terminating the alternatives, which
+        # the appended alternatives overwrite and then write again
+        if old_b.endswith(b'\n\n') and len(new_b) > len(old_b) \
+                and new_b.startswith(old_b[:-1]):
+            _write_all(fd, new_b[len(old_b) - 1:], len(old_b) - 1)
+            os.fsync(fd)
+            return
+    finally:
+        os.close(fd)
+    directory, name = os.path.split(path)
+    _apply_dir(directory, {name: new}, (), _replace_file)
+
+
+def _signature(path: str):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+# reported by watchers when changes may have been missed
+_RESCAN = ''
+
+
+class _PollWatcher:
+    """
+    stat based fallback for _InotifyWatcher: directories have their entries
+    compared, any other path is compared by itself
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.paths: Set[str] = set()
+        self.state: Dict[str, Any] = {}
+
+    def watch(self, paths: Iterable[str]):
+        self.paths.update(paths)
+        self.state = self._scan()
+
+    def _scan(self) -> Dict[str, Any]:
+        state = {}
+        for path in self.paths:
+            if os.path.isdir(path) and not os.path.islink(path):
+                with os.scandir(path) as entries:
+                    for e in entries:
+                        state[e.path] = _signature(e.path)
+            else:
+                state[path] = _signature(path)
+        return state
+
+    def read(self, timeout: Optional[float]) -> List[str]:
+        """paths changed since the last read, waiting at most timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self._scan()
+            changed = [p for p in state.keys() | self.state.keys()
+                       if state.get(p) != self.state.get(p)]
+            self.state = state
+            if changed:
+                return changed
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return []
+            time.sleep(self.interval if remaining is None else min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher:
+    """linux inotify(7) through ctypes, watching the parents of paths"""
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM \
+        | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.dirs: Dict[int, str] = {}
+
+    def watch(self, paths: Iterable[str]):
+        dirs = {p if os.path.isdir(p) and not os.path.islink(p)
+                else os.path.dirname(p) for p in paths}
+        for d in dirs - set(self.dirs.values()):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), self.MASK)
+            # missing directories can not hold anything we care about
+            if wd >= 0:
+                self.dirs[wd] = d
+
+    def read(self, timeout: Optional[float]) -> List[str]:
+        """paths changed since the last read, waiting at most timeout"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        changed = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    # events were lost, nothing short of a rescan will do
+                    changed.append(_RESCAN)
+                elif mask & self.IN_IGNORED:
+                    # the directory is gone (or unmounted), and so is the wd
+                    self.dirs.pop(wd, None)
+                    changed.append(_RESCAN)
+                elif wd in self.dirs:
+                    changed.append(os.path.join(self.dirs[wd], os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _watcher(poll: Optional[float]) -> Union[_InotifyWatcher, _PollWatcher]:
+    if poll is None:
+        try:
+            return _InotifyWatcher()
+        except (OSError, AttributeError, TypeError):
+            # no libc or no inotify (not linux)
+            pass
+    return _PollWatcher(poll or 2.0)
+
+
 # noinspection PyMethodMayBeStatic
 @dataclass
 class AlternativeUpdater:
     options: Options = field(default_factory=Options)
+    _resolved: Optional[ResolvedOptions] = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def resolved(self) -> ResolvedOptions:
+        """options with root and instdir applied, computed on first use"""
+        if self._resolved is None:
+            self._resolved = ResolvedOptions.of(self.options)
+        return self._resolved
 
     def install(self, installation: Installation):
-        """untested"""
-        admin_path = Path(self.options.admindir).joinpath(installation.name)
-        alt_path = Path(self.options.altdir).joinpath(installation.name)
+        r = self.resolved
+        admin_path = r.admin(installation.name)
+        # what the master link points to
+        alt_path = r.target_alt(installation.name)
+        text = None
 
-        if not admin_path.exists():
+        if not os.path.exists(admin_path):
             query = AlternativeUpdater.Query(
                 name=installation.name,
                 link=installation.link,
@@ -167,15 +592,14 @@ class AlternativeUpdater:
                 value=installation.path,
                 alternatives=[installation.as_alternative()]
             )
-            # if new alternative is the only one, link it
-            # but: if you install and there are others, don't
-            # todo confirm what update-alternatives does and match
+            # the new alternative is the only one, link it
             # inner link:
-            os.link(src=alt_path, dst=query.best)
+            self.link_alternative(query.alternatives[0], query.name)
             # outer link:
-            os.link(src=installation.link, dst=alt_path)
+            os.symlink(alt_path, r.inst(installation.link))
         else:
-            query = AlternativeUpdater.Query.parse(admin_path)
+            text = _read_text(admin_path)
+            query = self._parse(admin_path, text)
 
             # allow the user to manipulate the outer link here
             if query.link != installation.link:
@@ -183,9 +607,9 @@ class AlternativeUpdater:
                 print(f'update_alternatives: renaming {query.name} link '
                       f'from {query.link} to {installation.link}')
                 # remove old
-                os.remove(query.link)
+                os.remove(r.inst(query.link))
                 # create new
-                os.link(src=installation.link, dst=alt_path)
+                os.symlink(alt_path, r.inst(installation.link))
                 # update database
                 query.link = installation.link
 
@@ -198,9 +622,19 @@ class AlternativeUpdater:
                     found = True
                     break
             if not found:
-                query.alternatives.append(installation.as_alternative())
+                alt = installation.as_alternative()
+                # creating secondaries is not supported, leave them empty
+                alt.secondaries = [AlternativeUpdater.Query.Secondary(name='', link='')
+                                   for _ in query.secondaries]
+                query.alternatives.append(alt)
+
+            # in auto mode, follow the best alternative
+            best = query.get_best()
+            query.best = best.location
+            if query.status == 'auto' and _readlink(r.alt(query.name)) != best.location:
+                self.link_alternative(best, query.name, query.secondaries)
 
-        admin_path.write_text(query.stringify())
+        _write_admin(admin_path, text, query.stringify())
 
     def set(self, name_and_path: NameAndPath):
         n = name_and_path.name
@@ -217,17 +651,94 @@ class AlternativeUpdater:
     def link_alternative(
             self,
             alternative: 'AlternativeUpdater.Query.Alternative',
-            name: str
+            name: str,
+            secondaries: Iterable['AlternativeUpdater.Query.Secondary'] = ()
     ):
-        alt_path = Path(self.options.altdir).joinpath(name)
-        os.remove(alt_path)
-        os.link(src=alt_path, dst=alternative.location)
+        """points altdir/name (and altdir/secondary) at the alternative"""
+        r = self.resolved
+        links = [(r.alt(name), alternative.location)]
+        for s, alt_s in zip(secondaries, alternative.secondaries):
+            links.append((r.alt(s.name), alt_s.link))
+
+        _unlink_all(alt_path for alt_path, _ in links)
+        for alt_path, target in links:
+            # a choice may not provide every secondary
+            if target:
+                os.symlink(target, alt_path)
+
+    def remove(self, removal: Removal):
+        if removal.prefix is not None:
+            self._remove_prefix(removal.prefix)
+            return
+
+        if removal.name is None or removal.path is None:
+            raise Exception('remove requires a name and path, or --prefix')
 
-    def remove(self, name_and_path: NameAndPath):
-        print(f'remove: name_and_path: {name_and_path}')
+        query = self._query(removal.name)
+        if not any(a.location == removal.path for a in query.alternatives):
+            raise Exception(f'not a registered alternative for {removal.name}: {removal.path}')
+        self._purge(query, {removal.path})
 
     def remove_all(self, name: Name):
-        print(f'remove_all: name: {name}')
+        query = self._query(name.name)
+        self._purge(query, {a.location for a in query.alternatives})
+
+    def _remove_prefix(self, prefix: str):
+        """one pass over admindir, purging alternatives under prefix"""
+        # read everything before changing anything
+        purges = []
+        for admin_path in self._admin_paths():
+            try:
+                query = self._parse(admin_path)
+            except Exception as e:
+                print(f'update_alternatives: could not read {admin_path}: {e}',
+                      file=sys.stderr)
+                continue
+            locations = {a.location for a in query.alternatives
+                         if _is_under(a.location, prefix)}
+            if locations:
+                purges.append((query, locations))
+
+        for query, locations in purges:
+            self._purge(query, locations)
+
+    def _purge(self, query: 'AlternativeUpdater.Query', locations: Set[str]):
+        """
+        drops locations from the alternative, writing the admin file at most
+        once and removing all of the links in a single batch
+        """
+        r = self.resolved
+        admin_path = r.admin(query.name)
+        alt_path = r.alt(query.name)
+
+        remaining = [a for a in query.alternatives if a.location not in locations]
+        if not remaining:
+            # nothing left to point to - the whole link group goes away,
+            # but only links which are ours: never a file put in their place
+            links = []
+            for name, link in [(query.name, query.link)] + \
+                    [(s.name, s.link) for s in query.secondaries]:
+                if _readlink(r.inst(link)) == r.target_alt(name):
+                    links.append(r.inst(link))
+                if _readlink(r.alt(name)) is not None:
+                    links.append(r.alt(name))
+            _unlink_all(links)
+            os.unlink(admin_path)
+            return
+
+        query.alternatives = remaining
+        best = query.get_best()
+        query.best = best.location
+
+        # a manual selection which was removed falls back to automatic mode
+        current = _readlink(alt_path)
+        if current in locations:
+            query.status = 'auto'
+        if query.status == 'auto' and current != best.location:
+            self.link_alternative(best, query.name, query.secondaries)
+            query.value = best.location
+
+        _write_admin(admin_path, None, query.stringify())
 
     def all(self):
         print(f'all')
@@ -239,9 +750,129 @@ class AlternativeUpdater:
         highest = q.get_best()
         self.set(NameAndPath(name=name.name, path=highest.location))
 
+    def watch(self, watch: Watch):
+        """blocks forever, reconciling the alternatives affected by changes"""
+        debounce = 0.2 if watch.debounce is None else watch.debounce
+        # steady traffic must not postpone reconciling forever
+        max_delay = max(1.0, 10 * debounce)
+        admindir = self.resolved.admindir
+        watcher = _watcher(watch.poll)
+        try:
+            index = self._watch_index()
+            watcher.watch([admindir, *index])
+            self._reconcile_all(set().union(*index.values()))
+
+            while True:
+                changed = set(watcher.read(None))
+                # wait for the burst to be over
+                deadline = time.monotonic() + max_delay
+                while True:
+                    remaining = deadline - time.monotonic()
+                    more = watcher.read(min(debounce, remaining)) if remaining > 0 else []
+                    if not more:
+                        break
+                    changed.update(more)
+
+                if _RESCAN in changed:
+                    index = self._watch_index()
+                    watcher.watch([admindir, *index])
+                    self._reconcile_all(set().union(*index.values()))
+                    continue
+
+                names: Set[str] = set()
+                reindex = False
+                for path in changed:
+                    names.update(index.get(path, ()))
+                    if os.path.dirname(path) == admindir:
+                        names.add(os.path.basename(path))
+                        reindex = True
+
+                self._reconcile_all(names)
+                if reindex:
+                    index = self._watch_index()
+                    watcher.watch(list(index))
+        finally:
+            watcher.close()
+
+    def _reconcile_all(self, names: Iterable[str]):
+        """reconciles each alternative, one failing does not stop the others"""
+        for name in sorted(names):
+            try:
+                self._reconcile(name)
+            except Exception as e:
+                print(f'update_alternatives: could not reconcile {name}: {e}',
+                      file=sys.stderr)
+
+    def _watch_index(self) -> Dict[str, Set[str]]:
+        """every path an alternative depends on -> names of alternatives"""
+        r = self.resolved
+        index: Dict[str, Set[str]] = defaultdict(set)
+        for admin_path in self._admin_paths():
+            try:
+                q = self._parse(admin_path)
+            except Exception as e:
+                # possibly half written, its next change will be noticed
+                print(f'update_alternatives: could not read {admin_path}: {e}',
+                      file=sys.stderr)
+                index[admin_path].add(os.path.basename(admin_path))
+                continue
+            paths = [admin_path, r.alt(q.name), r.inst(q.link)]
+            paths.extend(r.alt(s.name) for s in q.secondaries)
+            paths.extend(r.inst(s.link) for s in q.secondaries)
+            for a in q.alternatives:
+                paths.append(r.inst(a.location))
+                paths.extend(r.inst(s.link) for s in a.secondaries if s.link)
+            for path in paths:
+                index[path].add(q.name)
+        return index
+
+    def _reconcile(self, name: str):
+        """
+        brings one alternative back in line with its admin file: drops choices
+        whose files are gone and relinks whatever no longer points to the
+        selected choice
+        """
+        r = self.resolved
+        admin_path = r.admin(name)
+        if not os.path.exists(admin_path):
+            return
+        query = self._parse(admin_path)
+
+        missing = {a.location for a in query.alternatives
+                   if not os.path.exists(r.inst(a.location))}
+        if missing:
+            print(f'update_alternatives: removing missing alternatives '
+                  f'for {name}: {", ".join(sorted(missing))}')
+            self._purge(query, missing)
+            if not os.path.exists(admin_path):
+                return
+
+        current = _readlink(r.alt(name))
+        selected = None
+        if query.status != 'auto':
+            selected = next((a for a in query.alternatives if a.location == current), None)
+        if selected is None:
+            if query.status != 'auto':
+                query.status = 'auto'
+                _write_admin(admin_path, None, query.stringify())
+            selected = query.get_best()
+
+        targets = [current] + [_readlink(r.alt(s.name)) for s in query.secondaries]
+        # a secondary the choice does not provide has no link at all
+        wanted = [selected.location] + [s.link or None for s in selected.secondaries]
+        if targets != wanted:
+            self.link_alternative(selected, name, query.secondaries)
+
+        # recreate master and secondary links that were deleted outright
+        links = [(r.inst(query.link), r.target_alt(name))]
+        links.extend((r.inst(s.link), r.target_alt(s.name)) for s in query.secondaries)
+        for link, alt in links:
+            if not os.path.lexists(link):
+                os.symlink(alt, link)
+
     def display(self, name: Name):
         q = self._query(name.name)
-        print(q.to_display(self.options))
+        print(q.to_display(self.resolved))
 
     def get_selections(self):
         print(f'get_selections')
@@ -249,102 +880,213 @@ class AlternativeUpdater:
     def set_selections(self):
         print(f'set_selections')
 
+    def snapshot(self, archive: Archive):
+        state = self._state()
+        data = json.dumps({
+            'version': 1,
+            'checksum': _checksum(state),
+            'state': state,
+        }, separators=(',', ':')).encode('utf-8')
+        Path(archive.path).write_bytes(gzip.compress(data))
+
+    def restore(self, archive: Archive):
+        """makes this root match a snapshot, only touching what differs"""
+        data = json.loads(gzip.decompress(Path(archive.path).read_bytes()))
+        state = data['state']
+        if data.get('version') != 1 or data.get('checksum') != _checksum(state):
+            raise Exception(f'not a valid snapshot: {archive.path}')
+
+        current = self._state()
+        if not self.options.force and _checksum(current) == data['checksum']:
+            print(f'update_alternatives: already matches {archive.path}')
+            return
+
+        # admin files: only write those which changed, drop the extra ones
+        admin = {n: t for n, t in state['admin'].items()
+                 if current['admin'].get(n) != t}
+        r = self.resolved
+        _apply_dir(r.admindir, admin,
+                   current['admin'].keys() - state['admin'].keys(),
+                   _replace_file)
+
+        # links in altdir, and the master links wherever they live; links of
+        # groups which are gone are removed only if they are still ours
+        alt: Dict[str, Optional[str]] = \
+            dict.fromkeys(current['alt'].keys() - state['alt'].keys())
+        alt.update((n, t) for n, t in state['alt'].items() if current['alt'].get(n) != t)
+        _apply_dir(r.altdir, alt, (), _replace_symlink)
+
+        ours = {r.target_alt(n) for n in current['alt']}
+        by_dir: Dict[str, Dict[str, Optional[str]]] = defaultdict(dict)
+        for link in current['links'].keys() - state['links'].keys():
+            if current['links'][link] in ours:
+                directory, name = os.path.split(r.inst(link))
+                by_dir[directory][name] = None
+        for link, target in state['links'].items():
+            if current['links'].get(link) != target:
+                directory, name = os.path.split(r.inst(link))
+                by_dir[directory][name] = target
+        for directory, links in by_dir.items():
+            _apply_dir(directory, links, (), _replace_symlink)
+
+    def _state(self) -> Dict[str, Dict[str, Optional[str]]]:
+        """admin files (as stringified) and the targets of their links"""
+        r = self.resolved
+        state: Dict[str, Dict[str, Optional[str]]] = {'admin': {}, 'alt': {}, 'links': {}}
+        for admin_path in self._admin_paths():
+            q = self._parse(admin_path)
+            state['admin'][q.name] = q.stringify()
+            for name, link in [(q.name, q.link)] + [(s.name, s.link) for s in q.secondaries]:
+                state['alt'][name] = _readlink(r.alt(name))
+                state['links'][link] = _readlink(r.inst(link))
+        return state
+
+    def _admin_paths(self) -> List[str]:
+        admindir = self.resolved.admindir
+        if not os.path.isdir(admindir):
+            return []
+        with os.scandir(admindir) as entries:
+            return [e.path for e in entries
+                    if e.is_file() and not e.name.startswith('.')]
+
+    def _parse(self, path: str, text: Optional[str] = None) -> 'AlternativeUpdater.Query':
+        return AlternativeUpdater.Query.parse(path, text, self.resolved.instdir)
+
     def _query(self, name: str):
-        path = Path(self.options.admindir).joinpath(name)
-        if not path.exists():
+        path = self.resolved.admin(name)
+        if not os.path.exists(path):
             raise Exception(f'no such alternative: {name}')
-        query = AlternativeUpdater.Query.parse(path)
+        query = self._parse(path)
         return query
 
     def query(self, name: Name):
-        print(self._query(name.name).to_query())
+        print(self._query(name.name).to_query(self.resolved.instdir))
 
     def list(self, name: Name):
         q = self._query(name.name)
         print('\n'.join([a.location for a in q.alternatives]))
 
-    def config(self, name: Name):
-        q = self._query(name.name)
+    def config(self, configuration: Configuration):
+        q = self._query(configuration.name)
         n = len(q.alternatives)
-        a = name.name
-        p = q.link
-        print(f'There are {n} choices for the alternative {a} (providing {p}).')
-        print()
 
         # sanity check
         if n == 0:
             raise Exception('cannot configure as there are no choices')
 
+        # go through alternatives and pick out values
+        alts = sorted(q.alternatives, key=lambda x: x.priority)
+
+        # non-interactive
+        if configuration.choose is not None:
+            self._select(q, self._choice(alts, configuration.choose))
+            return
+
+        a = configuration.name
+        p = q.link
+        print(f'There are {n} choices for the alternative {a} (providing {p}).')
+        print()
+
         # selected (y/n), choice #, path of choice, priority, auto/manual
         headers = [' ', 'Selection   ', 'Path', 'Priority  ', 'Status']
 
         # to be able to tell who is selected, get the current selection
-        cur = str(_readlink_f(Path(self.options.altdir).joinpath(name.name)))
-
-        # go through alternatives and pick out values
-        alts = sorted(q.alternatives, key=lambda x: x.priority)
-
-        # first row is the automatic selection
-        selections = [[
-            '*' if q.status == 'auto' else ' ',
-            '0', alts[-1].location,
-            f' {alts[-1].priority}',
-            'auto mode'
-        ]]
-
-        # then go through manual options
-        for i, alt in enumerate(alts):
-            selections.append([
-                '*' if cur == alt.location else ' ',
-                str(i + 1),
-                alt.location,
-                f' {alt.priority}',
-                'manual mode'
-            ])
-
-        # adjust widths
-        max_widths = [max([len(td) for td in col])
-                      for col in zip(*([headers] + selections))]
-        dash_lines = ['-' * (sum(max_widths) + 5)]
-        header_lines = [' '.join(c.ljust(w) for c, w in zip(row, max_widths))
-                        for row in [headers]]
-        selection_lines = [' '.join(c.ljust(w) for c, w in zip(row, max_widths))
-                           for row in selections]
-
-        # print the lines
-        print('\n'.join(header_lines + dash_lines + selection_lines))
-
-        # prompt the user
-        choice = input('Press <enter> to keep the current choice[*], or type selection number: ')
+        cur = _readlink(self.resolved.alt(configuration.name))
+        best = q.get_best()
+        matches = _matcher(configuration.filter)
+
+        def rows() -> Iterator[List[str]]:
+            # first row is the automatic selection
+            yield [
+                '*' if q.status == 'auto' else ' ',
+                '0', best.location,
+                f' {best.priority}',
+                'auto mode'
+            ]
+            # then go through manual options, keeping their numbers
+            for i, alt in enumerate(alts):
+                if matches(alt.location):
+                    yield [
+                        '*' if q.status != 'auto' and cur == alt.location else ' ',
+                        str(i + 1),
+                        alt.location,
+                        f' {alt.priority}',
+                        'manual mode'
+                    ]
+
+        page = configuration.page or max(10, shutil.get_terminal_size().lines - 6)
+        widths = [len(h) for h in headers]
+        remaining = rows()
+        first = True
+        while True:
+            pending = list(islice(remaining, page + 1))
+            selections, more = pending[:page], len(pending) > page
+            remaining = chain(pending[page:], remaining)
+
+            # adjust widths, only ever looking at the rows of this page
+            for row in selections:
+                widths = [max(w, len(td)) for w, td in zip(widths, row)]
+            lines = [' '.join(c.ljust(w) for c, w in zip(row, widths))
+                     for row in selections]
+            if first:
+                lines = [' '.join(c.ljust(w) for c, w in zip(headers, widths)),
+                         '-' * (sum(widths) + 5)] + lines
+                first = False
+
+            # print the lines
+            print('\n'.join(lines))
+
+            # prompt the user
+            if more:
+                choice = input('Press <enter> to keep the current choice[*], '
+                               'type selection number, or n for more: ')
+                if choice == 'n':
+                    continue
+            else:
+                choice = input('Press <enter> to keep the current choice[*], '
+                               'or type selection number: ')
+            break
 
         # user kept the default
         if not choice:
             return
 
-        # handle non-integer input
+        self._select(q, self._choice(alts, choice))
+
+    def _choice(self, alts: List['AlternativeUpdater.Query.Alternative'], choice: str) \
+            -> Optional['AlternativeUpdater.Query.Alternative']:
+        """selection number or path of a choice, None meaning auto"""
         try:
             # choice number
             ch_num = int(choice)
         except ValueError as v:
-            raise Exception(
-                'You must either enter a number'
-                ' or leave the selection blank to keep the current choice'
-            ) from v
+            match = next((a for a in alts if a.location == choice), None)
+            if match is None:
+                raise Exception(
+                    'You must either enter a number, the path of a choice'
+                    ' or leave the selection blank to keep the current choice'
+                ) from v
+            return match
 
         # handle out of range input
         if ch_num < 0 or ch_num > len(alts):
             raise Exception(f'valid choices are between 0 and {len(alts)}')
 
-        # todo if user chose auto, update the db with this
+        return alts[ch_num - 1] if ch_num > 0 else None
 
-        choice_entity = alts[ch_num - 1] if ch_num > 0 else alts[-1]
-        if choice_entity.location == cur:
-            # everything is as it should be
-            return
+    def _select(self,
+                query: 'AlternativeUpdater.Query',
+                choice: Optional['AlternativeUpdater.Query.Alternative']):
+        """applies a choice (None for auto mode) to links and admin file"""
+        status = 'auto' if choice is None else 'manual'
+        choice = choice or query.get_best()
+
+        if query.status != status:
+            query.status = status
+            _write_admin(self.resolved.admin(query.name), None, query.stringify())
 
-        # time to fix it
-        raise Exception('not implemented yet')
-        # self.link_alternative(choice_entity, name.name)
+        if _readlink(self.resolved.alt(query.name)) != choice.location:
+            self.link_alternative(choice, query.name, query.secondaries)
 
     @dataclass
     class Query:
@@ -388,13 +1130,13 @@ class AlternativeUpdater:
             lines.append('')
             return '\n'.join(lines)
 
-        def to_query(self) -> str:
+        def to_query(self, instdir: str = '') -> str:
             lines = [
                 f'Name: {self.name}',
                 f'Link: {self.link}',
                 f'Status: {self.status}',
                 f'Best: {self.best}',
-                f'Value: {_readlink_f(Path(self.link))}',
+                f'Value: {_readlink_f(Path(self.link), instdir)}',
             ]
 
             for a in (self.alternatives or []):
@@ -408,8 +1150,16 @@ class AlternativeUpdater:
             return AlternativeUpdater.Query.Alternative.best(*self.alternatives)
 
         @staticmethod
-        def parse(path: Path) -> 'AlternativeUpdater.Query':
-            lines = [i.strip() for i in path.read_text('utf-8').split('\n')]
+        def parse(path: Union[str, Path],
+                  text: Optional[str] = None,
+                  instdir: str = '') -> 'AlternativeUpdater.Query':
+            """
+            text, if given, is the already read content of path, and instdir
+            is where the links are, for reading the current value
+            """
+            if text is None:
+                text = _read_text(path)
+            lines = [i.strip() for i in text.split('\n')]
 
             # @formatter:off
             i = 0
@@ -437,7 +1187,7 @@ class AlternativeUpdater:
                 for j in range(len(secondaries)):
                     alt_sec.append(
                         AlternativeUpdater.Query.Secondary(
-                            name=Path(lines[i]).name,
+                            name=lines[i].rpartition('/')[2],
                             link=lines[i]
                         )
                     )
@@ -445,20 +1195,21 @@ class AlternativeUpdater:
                 # i += 1
 
             return AlternativeUpdater.Query(
-                name=path.name,
+                name=os.path.basename(path),
                 link=link,
                 status=status,
                 best=AlternativeUpdater.Query.Alternative.best(*alternatives).location,
-                value=str(_readlink_f(Path(link))),
+                value=str(_readlink_f(Path(link), instdir)),
                 secondaries=secondaries,
                 alternatives=alternatives,
             )
 
-        def to_display(self, options: Options) -> str:
+        def to_display(self, resolved: ResolvedOptions) -> str:
+            current = _readlink_f(Path(resolved.target_alt(self.name)), resolved.instdir)
             lines = [
                 f'{self.name} - {self.status} mode',
                 f'  link best version is {self.get_best().location}',
-                f'  link currently points to {_readlink_f(Path(options.altdir).joinpath(self.name))}',
+                f'  link currently points to {current}',
                 f'  link {self.name} is {self.link}',
                 *[f'  secondary {s.name} is {s.link}' for s in self.secondaries],
             ]
@@ -469,6 +1220,12 @@ class AlternativeUpdater:
             return '\n'.join(lines)
 
 
+def _optional_type(type_: Any) -> Any:
+    """Optional[X] -> X, so that argparse can call it"""
+    args = [a for a in get_args(type_) if a is not type(None)]
+    return args[0] if args else type_
+
+
 def run(args: Optional[List[str]] = None):
     parser = ArgumentParser()
 
@@ -498,7 +1255,17 @@ def run(args: Optional[List[str]] = None):
         # noinspection PyDataclass
         cmd_fields = fields(cmd_type)
         for f in cmd_fields:
-            cmd_parser.add_argument(f.name, type=f.type)
+            f_type = _optional_type(f.type)
+            if f.default is MISSING:
+                cmd_parser.add_argument(f.name, type=f_type)
+            elif f.metadata.get('positional'):
+                cmd_parser.add_argument(f.name, nargs='?', type=f_type)
+            elif f_type is bool:
+                cmd_parser.add_argument(f'--{f.name.replace("_", "-")}',
+                                        dest=f.name, action='store_true')
+            else:
+                cmd_parser.add_argument(f'--{f.name.replace("_", "-")}',
+                                        dest=f.name, type=f_type)
 
     if args is None:
         import sys